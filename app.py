@@ -1,6 +1,59 @@
+import hashlib
+import io
+from sys import intern
+from xml.parsers import expat
+from xml.sax.saxutils import escape
+
 import streamlit as st
-import xml.etree.ElementTree as ET
-import pandas as pd
+import numpy as np
+
+from attr_index import UnsupportedMarkupError, build_attr_index, splice_values
+
+try:
+    from lxml import etree as ET
+    _HAVE_LXML = True
+except ImportError:
+    # Slower, but keeps the app usable where lxml is not installed.
+    import xml.etree.ElementTree as ET
+    _HAVE_LXML = False
+
+# The attributes Apply can edit: directly under a <track> or under one of its <box>es.
+if _HAVE_LXML:
+    # Compiled once and reused for every track.
+    _EDITABLE_ATTRS = ET.XPath("attribute | box/attribute")
+else:
+    def _EDITABLE_ATTRS(track):
+        return track.findall("attribute") + track.findall("box/attribute")
+
+# The index is never mutated, so one copy per file is shared by every session and
+# rerun. Keyed on the upload hash; Streamlit skips hashing `_xml_bytes`.
+@st.cache_resource(max_entries=8, show_spinner=False)
+def load_attr_index(xml_hash: str, _xml_bytes: bytes):
+    return build_attr_index(_xml_bytes)
+
+
+# Tracks Overview rows shown before "Show all" is turned on
+_OVERVIEW_ROWS = 500
+
+# session_state key prefixes of the rules for the current upload
+_PER_FILE_KEYS = (
+    "ranges_", "scope_", "single_start_", "single_end_", "value_choice_", "custom_value_",
+)
+
+_EMPTY_INDEX_ENTRY = ([], np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+
+def merge_ranges(ranges):
+    # (start, end) pairs -> sorted, disjoint ranges as an (n, 2) array of inclusive
+    # [start, end] rows; overlapping or adjacent ranges are folded.
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return np.array(merged, dtype=np.int64).reshape(-1, 2)
+
 
 st.set_page_config(page_title="CVAT Attribute Range Editor", layout="wide")
 
@@ -29,61 +82,106 @@ if not uploaded_file:
 xml_bytes = uploaded_file.getvalue()
 
 # -----------------------------
-# PARSE XML
+# COLLECT TRACK + ATTRIBUTE INFO
 # -----------------------------
+# Streamlit reruns the whole script on every widget interaction, so everything
+# derived from the upload is keyed on a hash of its bytes.
+xml_hash = hashlib.blake2b(xml_bytes, digest_size=16).hexdigest()
+
+# Rules are per file: a different upload drops the scopes, ranges and values
+# picked for the previous one instead of carrying them over by track id.
+if st.session_state.get("file_hash") != xml_hash:
+    for key in [k for k in st.session_state if k.startswith(_PER_FILE_KEYS)]:
+        del st.session_state[key]
+    st.session_state["file_hash"] = xml_hash
+
+# Streamed with iterparse and finished tracks are dropped, so the overview never
+# holds the whole DOM. Streamlit skips hashing the underscore-prefixed `_xml_bytes`.
+# Capped like the index cache so a long-running server doesn't keep every upload.
+@st.cache_data(max_entries=8, show_spinner=False)
+def collect_track_info(xml_hash: str, _xml_bytes: bytes):
+    attribute_values = {}   # {attr_name: set(values)}
+    # Tracks Overview columns, passed to st.dataframe as-is
+    track_ids = []
+    track_labels = []
+    track_attrs = []
+
+    # One event per finished <track> (lxml filters the tag in C; stdlib yields
+    # every element). <attribute>s elsewhere, e.g. <meta> label specs, never match.
+    iterparse_kw = {"tag": "track", "huge_tree": True} if _HAVE_LXML else {}
+    # Local aliases for the per-attribute loop below
+    values_for = attribute_values.setdefault
+    intern_name = intern
+    for _, track in ET.iterparse(io.BytesIO(_xml_bytes), events=("end",), **iterparse_kw):
+        if track.tag != "track":
+            continue
+
+        attrs_in_track = set()
+        add_name = attrs_in_track.add
+        # Track- and box-level attributes in one query; both feed the same sets.
+        for attr in _EDITABLE_ATTRS(track):
+            name = attr.get("name")
+            if not name:
+                continue
+            name = intern_name(name)
+            add_name(name)
+            value = (attr.text or "").strip()
+            values_for(name, set()).add(value)
+
+        track_ids.append(track.get("id", ""))
+        track_labels.append(track.get("label", ""))
+        track_attrs.append(", ".join(sorted(attrs_in_track)))
+
+        # Free the finished track (and, with lxml, earlier siblings) to keep memory flat.
+        track.clear()
+        if _HAVE_LXML:
+            while track.getprevious() is not None:
+                del track.getparent()[0]
+
+    # Sorted once per upload, not on every rerun:
+    # {attr_name: tuple of non-empty values}, with attribute names in sorted order.
+    attribute_values = {
+        name: tuple(sorted(v for v in values if v))
+        for name, values in sorted(attribute_values.items())
+    }
+    track_infos = {"Track ID": track_ids, "Label": track_labels, "Attributes": track_attrs}
+    # Option labels for the track multiselect -> track id
+    track_label_to_id = {
+        f"{t_id} – {label}": t_id for t_id, label in zip(track_ids, track_labels)
+    }
+    return attribute_values, track_infos, track_label_to_id
+
+
 try:
-    root = ET.fromstring(xml_bytes)
+    attribute_values, track_infos, track_label_to_id = collect_track_info(
+        xml_hash, xml_bytes
+    )
 except ET.ParseError as e:
     st.error(f"❌ XML Parse Error: {e}")
     st.stop()
 
-tracks = root.findall(".//track")
-st.write(f"Found **{len(tracks)}** `<track>` elements.")
+st.write(f"Found **{len(track_infos['Track ID'])}** `<track>` elements.")
 
-if not tracks:
+if not track_infos["Track ID"]:
     st.error("❌ No <track> elements found. This is probably not a CVAT *video* XML export.")
     st.stop()
 
-# -----------------------------
-# COLLECT TRACK + ATTRIBUTE INFO
-# -----------------------------
-attribute_values = {}   # {attr_name: set(values)}
-track_infos = []
-
-for track in tracks:
-    t_id = track.get("id", "")
-    label = track.get("label", "")
-    attrs_in_track = set()
-
-    # Track-level attributes
-    for attr in track.findall("attribute"):
-        name = attr.get("name")
-        if not name:
-            continue
-        attrs_in_track.add(name)
-        attribute_values.setdefault(name, set()).add((attr.text or "").strip())
-
-    # Box-level attributes
-    for box in track.findall("box"):
-        for attr in box.findall("attribute"):
-            name = attr.get("name")
-            if not name:
-                continue
-            attrs_in_track.add(name)
-            attribute_values.setdefault(name, set()).add((attr.text or "").strip())
-
-    track_infos.append({
-        "Track ID": t_id,
-        "Label": label,
-        "Attributes": ", ".join(sorted(attrs_in_track)) if attrs_in_track else "",
-    })
-
 if not attribute_values:
     st.error("No `<attribute>` elements found under tracks/boxes.")
     st.stop()
 
 st.subheader("Tracks Overview")
-st.dataframe(pd.DataFrame(track_infos), use_container_width=True)
+# The table is reference only, so it is built and sent to the browser only while
+# the toggle is on; large files show the first rows unless asked for all of them.
+if st.toggle("Show tracks table", key="_show_tracks"):
+    n_tracks = len(track_infos["Track ID"])
+    if n_tracks > _OVERVIEW_ROWS and not st.toggle(f"Show all {n_tracks} tracks"):
+        shown = {col: values[:_OVERVIEW_ROWS] for col, values in track_infos.items()}
+        st.caption(f"First {_OVERVIEW_ROWS} of {n_tracks} tracks.")
+    else:
+        shown = track_infos
+    # Column dict straight from the cached overview; no DataFrame needed for display.
+    st.dataframe(shown, use_container_width=True)
 
 # -----------------------------
 # 1️⃣ TRACK SELECTION
@@ -96,10 +194,6 @@ track_selection_mode = st.radio(
     horizontal=True,
 )
 
-track_label_to_id = {
-    f"{info['Track ID']} – {info['Label']}": info["Track ID"] for info in track_infos
-}
-
 if track_selection_mode == "Select specific tracks":
     selected_track_labels = st.multiselect(
         "Select tracks",
@@ -111,347 +205,365 @@ if track_selection_mode == "Select specific tracks":
     selected_track_ids = {track_label_to_id[lbl] for lbl in selected_track_labels}
 else:
     selected_track_labels = []
-    selected_track_ids = {info["Track ID"] for info in track_infos}
+    selected_track_ids = set(track_infos["Track ID"])
 
 st.write(f"Tracks chosen: **{len(selected_track_ids)}**")
 
 # -----------------------------
-# 2️⃣ ATTRIBUTE SELECTION
-# -----------------------------
-st.subheader("2️⃣ Select Attributes")
-
-all_attr_names = sorted(attribute_values.keys())
-selected_attrs = st.multiselect(
-    "Attributes to modify (you can choose multiple):",
-    all_attr_names,
-)
-if not selected_attrs:
-    st.info("Select at least one attribute.")
-    st.stop()
-
-# -----------------------------
-# 3️⃣ NEW VALUE PER ATTRIBUTE
+# RULE HELPERS
 # -----------------------------
-st.subheader("3️⃣ New values")
-
 def existing_values_for(attr_name):
-    values = attribute_values.get(attr_name, set())
-    return sorted(v for v in values if v)
+    return attribute_values.get(attr_name, ())
 
-for attr_name in selected_attrs:
-    st.markdown(f"### Attribute `{attr_name}`")
 
-    existing_vals = existing_values_for(attr_name)
-
-    value_choice = st.selectbox(
-        f"New value for `{attr_name}`",
-        existing_vals + ["⟶ Custom value"],
-        key=f"value_choice_{attr_name}",
-    )
-    if value_choice == "⟶ Custom value":
-        st.text_input(
-            f"Custom value for `{attr_name}`",
-            value="",
-            key=f"custom_value_{attr_name}",
-        )
-    st.markdown("---")
+# on_change callback: copies one range widget into its stored row. Runs before the
+# rerun, so rendering never writes to session_state.
+def _store_range_value(key: str, row_id: int, col: int, widget_key: str):
+    for row in st.session_state[key]:
+        if row[0] == row_id:
+            row[col] = st.session_state[widget_key]
 
-# -----------------------------
-# 4️⃣ SCOPES & FRAME RANGES
-# -----------------------------
-st.subheader("4️⃣ Scope & frame ranges")
 
-# Helper to manage multiple ranges (list of dicts: {"start": int, "end": int})
+# Helper to manage multiple ranges. session_state[key] is a list of
+# [row id, start, end] rows: the values outlive the widgets, which Streamlit drops
+# whenever they are not rendered (scope switched away, attribute deselected).
+# Ids are stable, so deleting a row doesn't shift the values of the rows after it.
 def ranges_ui(key_prefix: str, label_prefix: str):
     key = f"ranges_{key_prefix}"
-    if key not in st.session_state:
-        st.session_state[key] = []
+    rows = st.session_state.get(key, [])
 
-    delete_indices = []
-    for idx, r in enumerate(st.session_state[key]):
+    deleted = set()
+    for idx, (row_id, start, end) in enumerate(rows):
         c1, c2, c3 = st.columns([1, 1, 0.3])
         with c1:
-            st.session_state[key][idx]["start"] = st.number_input(
+            widget_key = f"{key_prefix}_start_{row_id}"
+            st.number_input(
                 f"{label_prefix} Start {idx+1}",
                 min_value=0,
-                value=r["start"],
+                value=start,
                 step=1,
-                key=f"{key_prefix}_start_{idx}",
+                key=widget_key,
+                on_change=_store_range_value,
+                args=(key, row_id, 1, widget_key),
             )
         with c2:
-            st.session_state[key][idx]["end"] = st.number_input(
+            widget_key = f"{key_prefix}_end_{row_id}"
+            st.number_input(
                 f"{label_prefix} End {idx+1}",
                 min_value=0,
-                value=r["end"],
+                value=end,
                 step=1,
-                key=f"{key_prefix}_end_{idx}",
+                key=widget_key,
+                on_change=_store_range_value,
+                args=(key, row_id, 2, widget_key),
             )
         with c3:
-            if st.button("🗑️", key=f"{key_prefix}_del_{idx}"):
-                delete_indices.append(idx)
+            if st.button("🗑️", key=f"{key_prefix}_del_{row_id}"):
+                deleted.add(row_id)
 
-    for idx in reversed(delete_indices):
-        del st.session_state[key][idx]
+    added = st.button(f"➕ Add range ({label_prefix})", key=f"{key_prefix}_add")
 
-    if st.button(f"➕ Add range ({label_prefix})", key=f"{key_prefix}_add"):
-        st.session_state[key].append({"start": 0, "end": 0})
+    # At most one session_state write per call, and none while rendering rows.
+    if deleted or added or key not in st.session_state:
+        rows = [row for row in rows if row[0] not in deleted]
+        if added:
+            rows.append([max((row[0] for row in rows), default=-1) + 1, 0, 0])
+        st.session_state[key] = rows
 
     return key  # we will retrieve ranges later from session_state[key]
 
 
-# ---- GLOBAL SCOPES (ALL TRACKS MODE) ----
-if track_selection_mode == "Apply to ALL tracks":
+# Sections 2-5 run as a fragment: interacting with their widgets reruns only this
+# function, not the upload hashing, cached lookups and track table above.
+@st.fragment
+def rules_and_apply():
+    # -----------------------------
+    # 2️⃣ ATTRIBUTE SELECTION
+    # -----------------------------
+    st.subheader("2️⃣ Select Attributes")
+
+    all_attr_names = list(attribute_values)
+    selected_attrs = st.multiselect(
+        "Attributes to modify (you can choose multiple):",
+        all_attr_names,
+    )
+    if not selected_attrs:
+        st.info("Select at least one attribute.")
+        st.stop()
+    # Interned like the index keys, so name lookups hit the identity fast path.
+    selected_attrs = [intern(a) for a in selected_attrs]
+
+    # -----------------------------
+    # 3️⃣ NEW VALUE PER ATTRIBUTE
+    # -----------------------------
+    st.subheader("3️⃣ New values")
+
     for attr_name in selected_attrs:
-        st.markdown(f"### Scope for attribute `{attr_name}` (ALL selected tracks)")
-
-        scope_key = f"scope_global_{attr_name}"
-        scope = st.radio(
-            f"Scope for `{attr_name}`",
-            ["Entire track", "Single frame range", "Multiple frame ranges"],
-            horizontal=True,
-            key=scope_key,
-        )
+        st.markdown(f"### Attribute `{attr_name}`")
 
-        if scope == "Single frame range":
-            c1, c2 = st.columns(2)
-            with c1:
-                st.number_input(
-                    f"Start frame for `{attr_name}`",
-                    min_value=0,
-                    value=0,
-                    step=1,
-                    key=f"single_start_global_{attr_name}",
-                )
-            with c2:
-                st.number_input(
-                    f"End frame for `{attr_name}` (inclusive)",
-                    min_value=0,
-                    value=10,
-                    step=1,
-                    key=f"single_end_global_{attr_name}",
-                )
-        elif scope == "Multiple frame ranges":
-            ranges_ui(
-                key_prefix=f"global_{attr_name}",
-                label_prefix=f"{attr_name}",
+        existing_vals = existing_values_for(attr_name)
+
+        value_choice = st.selectbox(
+            f"New value for `{attr_name}`",
+            [*existing_vals, "⟶ Custom value"],
+            key=f"value_choice_{attr_name}",
+        )
+        if value_choice == "⟶ Custom value":
+            st.text_input(
+                f"Custom value for `{attr_name}`",
+                value="",
+                key=f"custom_value_{attr_name}",
             )
         st.markdown("---")
 
-# ---- PER-TRACK SCOPES (SPECIFIC TRACKS MODE) ----
-else:
-    for track_label in selected_track_labels:
-        t_id = track_label_to_id[track_label]
-        with st.expander(f"Track {track_label} – scopes & ranges"):
-            for attr_name in selected_attrs:
-                st.markdown(f"**Attribute `{attr_name}`**")
-
-                scope_key = f"scope_{t_id}_{attr_name}"
-                scope = st.radio(
-                    f"Scope for `{attr_name}` on track {t_id}",
-                    ["Entire track", "Single frame range", "Multiple frame ranges"],
-                    horizontal=True,
-                    key=scope_key,
-                )
-
-                if scope == "Single frame range":
-                    c1, c2 = st.columns(2)
-                    with c1:
-                        st.number_input(
-                            f"Start frame ({attr_name}, track {t_id})",
-                            min_value=0,
-                            value=0,
-                            step=1,
-                            key=f"single_start_{t_id}_{attr_name}",
-                        )
-                    with c2:
-                        st.number_input(
-                            f"End frame ({attr_name}, track {t_id})",
-                            min_value=0,
-                            value=10,
-                            step=1,
-                            key=f"single_end_{t_id}_{attr_name}",
-                        )
-                elif scope == "Multiple frame ranges":
-                    ranges_ui(
-                        key_prefix=f"{t_id}_{attr_name}",
-                        label_prefix=f"{attr_name} (track {t_id})",
-                    )
-                st.markdown("---")
+    # -----------------------------
+    # 4️⃣ SCOPES & FRAME RANGES
+    # -----------------------------
+    st.subheader("4️⃣ Scope & frame ranges")
 
-# -----------------------------
-# 5️⃣ APPLY CHANGES
-# -----------------------------
-if st.button("5️⃣ Apply changes and download XML", type="primary"):
-
-    # Helper: get new value for attribute
-    def get_new_value(attr_name: str) -> str:
-        choice = st.session_state.get(f"value_choice_{attr_name}")
-        if choice == "⟶ Custom value":
-            return (st.session_state.get(f"custom_value_{attr_name}", "") or "").strip()
-        return choice or ""
+    # ---- GLOBAL SCOPES (ALL TRACKS MODE) ----
+    if track_selection_mode == "Apply to ALL tracks":
+        for attr_name in selected_attrs:
+            st.markdown(f"### Scope for attribute `{attr_name}` (ALL selected tracks)")
+
+            scope_key = f"scope_global_{attr_name}"
+            scope = st.radio(
+                f"Scope for `{attr_name}`",
+                ["Entire track", "Single frame range", "Multiple frame ranges"],
+                horizontal=True,
+                key=scope_key,
+            )
 
-    # Validate values and ranges
-    for attr_name in selected_attrs:
-        new_val = get_new_value(attr_name)
-        if not new_val:
-            st.error(f"Value for attribute `{attr_name}` cannot be empty.")
-            st.stop()
+            if scope == "Single frame range":
+                c1, c2 = st.columns(2)
+                with c1:
+                    st.number_input(
+                        f"Start frame for `{attr_name}`",
+                        min_value=0,
+                        value=0,
+                        step=1,
+                        key=f"single_start_global_{attr_name}",
+                    )
+                with c2:
+                    st.number_input(
+                        f"End frame for `{attr_name}` (inclusive)",
+                        min_value=0,
+                        value=10,
+                        step=1,
+                        key=f"single_end_global_{attr_name}",
+                    )
+            elif scope == "Multiple frame ranges":
+                ranges_ui(
+                    key_prefix=f"global_{attr_name}",
+                    label_prefix=f"{attr_name}",
+                )
+            st.markdown("---")
+
+    # ---- PER-TRACK SCOPES (SPECIFIC TRACKS MODE) ----
+    else:
+        for track_label in selected_track_labels:
+            t_id = track_label_to_id[track_label]
+            with st.expander(f"Track {track_label} – scopes & ranges"):
+                for attr_name in selected_attrs:
+                    st.markdown(f"**Attribute `{attr_name}`**")
+
+                    scope_key = f"scope_{t_id}_{attr_name}"
+                    scope = st.radio(
+                        f"Scope for `{attr_name}` on track {t_id}",
+                        ["Entire track", "Single frame range", "Multiple frame ranges"],
+                        horizontal=True,
+                        key=scope_key,
+                    )
 
-        if track_selection_mode == "Apply to ALL tracks":
-            scope = st.session_state.get(f"scope_global_{attr_name}", "Entire track")
+                    if scope == "Single frame range":
+                        c1, c2 = st.columns(2)
+                        with c1:
+                            st.number_input(
+                                f"Start frame ({attr_name}, track {t_id})",
+                                min_value=0,
+                                value=0,
+                                step=1,
+                                key=f"single_start_{t_id}_{attr_name}",
+                            )
+                        with c2:
+                            st.number_input(
+                                f"End frame ({attr_name}, track {t_id})",
+                                min_value=0,
+                                value=10,
+                                step=1,
+                                key=f"single_end_{t_id}_{attr_name}",
+                            )
+                    elif scope == "Multiple frame ranges":
+                        ranges_ui(
+                            key_prefix=f"{t_id}_{attr_name}",
+                            label_prefix=f"{attr_name} (track {t_id})",
+                        )
+                    st.markdown("---")
+
+    # -----------------------------
+    # 5️⃣ APPLY CHANGES
+    # -----------------------------
+    if st.button("5️⃣ Apply changes and download XML", type="primary"):
+        # One plain-dict snapshot of the widget state; the lookups below skip the
+        # session_state proxy.
+        ss = st.session_state.to_dict()
+
+        # Helper: get new value for attribute
+        def get_new_value(attr_name: str) -> str:
+            choice = ss.get(f"value_choice_{attr_name}")
+            if choice == "⟶ Custom value":
+                return (ss.get(f"custom_value_{attr_name}", "") or "").strip()
+            return choice or ""
+
+        # Helper: validated scope of one attribute as merged (start, end) ranges,
+        # None = all frames. `where` names the track(s) in error messages.
+        def scope_ranges(scope_prefix: str, attr_name: str, where: str):
+            scope = ss.get(f"scope_{scope_prefix}_{attr_name}", "Entire track")
+            if scope == "Entire track":
+                return None
             if scope == "Single frame range":
-                start = st.session_state.get(f"single_start_global_{attr_name}", 0)
-                end = st.session_state.get(f"single_end_global_{attr_name}", 0)
+                start = ss.get(f"single_start_{scope_prefix}_{attr_name}", 0)
+                end = ss.get(f"single_end_{scope_prefix}_{attr_name}", 0)
                 if end < start:
                     st.error(
-                        f"For `{attr_name}` (ALL tracks), end frame ({end}) "
+                        f"For `{attr_name}` {where}, end frame ({end}) "
                         f"must be >= start frame ({start})."
                     )
                     st.stop()
-            elif scope == "Multiple frame ranges":
-                ranges_key = f"ranges_global_{attr_name}"
-                ranges = st.session_state.get(ranges_key, [])
-                for r in ranges:
-                    if r["end"] < r["start"]:
-                        st.error(
-                            f"For `{attr_name}` (ALL tracks), a range has end < start "
-                            f"({r['start']} – {r['end']})."
-                        )
-                        st.stop()
-        else:
-            # per track
-            for track_label in selected_track_labels:
-                t_id = track_label_to_id[track_label]
-                scope = st.session_state.get(
-                    f"scope_{t_id}_{attr_name}",
-                    "Entire track"
-                )
-                if scope == "Single frame range":
-                    start = st.session_state.get(f"single_start_{t_id}_{attr_name}", 0)
-                    end = st.session_state.get(f"single_end_{t_id}_{attr_name}", 0)
-                    if end < start:
-                        st.error(
-                            f"For `{attr_name}` on track {t_id}, end frame ({end}) "
-                            f"must be >= start frame ({start})."
-                        )
-                        st.stop()
-                elif scope == "Multiple frame ranges":
-                    ranges_key = f"ranges_{t_id}_{attr_name}"
-                    ranges = st.session_state.get(ranges_key, [])
-                    for r in ranges:
-                        if r["end"] < r["start"]:
-                            st.error(
-                                f"For `{attr_name}` on track {t_id}, a range has end < start "
-                                f"({r['start']} – {r['end']})."
-                            )
-                            st.stop()
-
-    # Re-parse fresh for modifications
-    new_root = ET.fromstring(xml_bytes)
-
-    total_changed_tracks = 0
-    total_changed_track_attrs = 0
-    total_changed_box_attrs = 0
-
-    for track in new_root.findall(".//track"):
-        t_id = track.get("id", "")
-        if t_id not in selected_track_ids:
-            continue
-
-        track_changed = False
+                return merge_ranges([(start, end)])
 
+            ranges = []
+            for _, start, end in ss.get(f"ranges_{scope_prefix}_{attr_name}", []):
+                if end < start:
+                    st.error(
+                        f"For `{attr_name}` {where}, a range has end < start "
+                        f"({start} – {end})."
+                    )
+                    st.stop()
+                ranges.append((start, end))
+            return merge_ranges(ranges)
+
+        # Validate and resolve everything outside the apply loop: one value per
+        # attribute, ranges per (track, attribute). Track None = ALL tracks mode,
+        # where the scope is shared.
+        new_values = {}
+        plan = {}
         for attr_name in selected_attrs:
             new_val = get_new_value(attr_name)
+            if not new_val:
+                st.error(f"Value for attribute `{attr_name}` cannot be empty.")
+                st.stop()
+            new_values[attr_name] = new_val
 
-            # Determine scope & ranges for this track+attr
             if track_selection_mode == "Apply to ALL tracks":
-                scope = st.session_state.get(
-                    f"scope_global_{attr_name}",
-                    "Entire track"
-                )
-                if scope == "Entire track":
-                    ranges = None  # means "all frames"
-                elif scope == "Single frame range":
-                    start = st.session_state.get(
-                        f"single_start_global_{attr_name}", 0
-                    )
-                    end = st.session_state.get(
-                        f"single_end_global_{attr_name}", 0
-                    )
-                    ranges = [{"start": start, "end": end}]
-                else:  # Multiple frame ranges
-                    ranges = st.session_state.get(
-                        f"ranges_global_{attr_name}", []
-                    )
+                plan[(None, attr_name)] = scope_ranges("global", attr_name, "(ALL tracks)")
             else:
-                scope = st.session_state.get(
-                    f"scope_{t_id}_{attr_name}",
-                    "Entire track"
+                for track_label in selected_track_labels:
+                    t_id = track_label_to_id[track_label]
+                    plan[(t_id, attr_name)] = scope_ranges(t_id, attr_name, f"on track {t_id}")
+
+        # The span index is only needed for editing, so it is built on the first Apply.
+        try:
+            attr_index, spans, encoding = load_attr_index(xml_hash, xml_bytes)
+        except expat.ExpatError as e:
+            st.error(f"❌ XML Parse Error: {e}")
+            st.stop()
+        except UnsupportedMarkupError as e:
+            st.error(f"❌ {e}")
+            st.stop()
+        except ValueError as e:
+            st.error(
+                f"❌ This file is encoded as {e}, which cannot be edited. "
+                "Re-save it as UTF-8 and upload it again."
+            )
+            st.stop()
+
+        # Values are escaped and encoded once, ready to be spliced into the document.
+        new_values = {
+            attr_name: escape(new_val).encode(encoding, "xmlcharrefreplace")
+            for attr_name, new_val in new_values.items()
+        }
+
+        # [(span ids, new value bytes)]; box span ids are slices of the index arrays,
+        # so no per-box work happens until the splice below.
+        edit_chunks = []
+
+        total_changed_tracks = 0
+        total_changed_track_attrs = 0
+        total_changed_box_attrs = 0
+
+        want_names = frozenset(selected_attrs)
+
+        # Only the selected tracks are visited; the splice below restores document order.
+        for t_id in selected_track_ids:
+            attrs_by_name = attr_index.get(t_id)
+            # One set test skips tracks that carry none of the selected attributes.
+            if attrs_by_name is None or want_names.isdisjoint(attrs_by_name):
+                continue
+
+            track_changed = False
+            plan_track = None if track_selection_mode == "Apply to ALL tracks" else t_id
+
+            for attr_name in selected_attrs:
+                new_val = new_values[attr_name]
+                ranges = plan[(plan_track, attr_name)]
+
+                track_spans, box_frames, box_spans = attrs_by_name.get(
+                    attr_name, _EMPTY_INDEX_ENTRY
                 )
-                if scope == "Entire track":
-                    ranges = None
-                elif scope == "Single frame range":
-                    start = st.session_state.get(
-                        f"single_start_{t_id}_{attr_name}", 0
-                    )
-                    end = st.session_state.get(
-                        f"single_end_{t_id}_{attr_name}", 0
-                    )
-                    ranges = [{"start": start, "end": end}]
-                else:
-                    ranges = st.session_state.get(
-                        f"ranges_{t_id}_{attr_name}", []
-                    )
 
-            # 1) Track-level attributes: always updated for selected tracks
-            for attr in track.findall("attribute"):
-                if attr.get("name") == attr_name:
-                    attr.text = new_val
-                    total_changed_track_attrs += 1
+                # 1) Track-level attributes: always updated for selected tracks
+                # 2) Box-level attributes: obey scope/ranges
+                if ranges is None:  # Entire track
+                    box_chunks = [box_spans]
+                else:
+                    # box_frames is sorted: each range is one binary-searched slice
+                    los = np.searchsorted(box_frames, ranges[:, 0], side="left")
+                    his = np.searchsorted(box_frames, ranges[:, 1], side="right")
+                    box_chunks = [box_spans[lo:hi] for lo, hi in zip(los, his)]
+
+                for chunk in (track_spans, *box_chunks):
+                    if len(chunk):
+                        edit_chunks.append((chunk, new_val))
+                changed_box_attrs = sum(len(chunk) for chunk in box_chunks)
+
+                total_changed_track_attrs += len(track_spans)
+                total_changed_box_attrs += changed_box_attrs
+                if track_spans or changed_box_attrs:
                     track_changed = True
 
-            # 2) Box-level attributes: obey scope/ranges
-            boxes = list(track.findall("box"))
-            if not boxes:
-                continue
+            if track_changed:
+                total_changed_tracks += 1
+
+        # Span ids follow document order, so sorting them orders the splices.
+        chunk_ids = [ids for ids, _ in edit_chunks]
+        span_ids = np.concatenate([np.empty(0, dtype=np.int64), *chunk_ids])
+        value_idx = np.repeat(np.arange(len(edit_chunks)), [len(ids) for ids in chunk_ids])
+        order = np.argsort(span_ids, kind="stable")
+
+        # Copy the untouched bytes between edited spans; nothing else is re-serialised.
+        # Written into a BytesIO handed straight to the download button, so the
+        # output is not copied into a separate bytes object first.
+        out = io.BytesIO()
+        edits = (
+            (span_id, edit_chunks[chunk_idx][1])
+            for span_id, chunk_idx in zip(span_ids[order].tolist(), value_idx[order].tolist())
+        )
+        splice_values(xml_bytes, spans, edits, encoding, out)
 
-            if ranges is None:  # Entire track
-                boxes_to_change = boxes
-            else:
-                boxes_to_change = []
-                for box in boxes:
-                    try:
-                        frame_idx = int(box.get("frame", "0"))
-                    except ValueError:
-                        frame_idx = 0
-                    if any(
-                        r["start"] <= frame_idx <= r["end"]
-                        for r in ranges
-                    ):
-                        boxes_to_change.append(box)
-
-            for box in boxes_to_change:
-                for attr in box.findall("attribute"):
-                    if attr.get("name") == attr_name:
-                        attr.text = new_val
-                        total_changed_box_attrs += 1
-                        track_changed = True
-
-        if track_changed:
-            total_changed_tracks += 1
-
-    out_bytes = ET.tostring(new_root, encoding="utf-8")
-
-    st.success(
-        f"Done! Modified XML:\n"
-        f"- Tracks affected: **{total_changed_tracks}**\n"
-        f"- Track-level attributes changed: **{total_changed_track_attrs}**\n"
-        f"- Box-level attributes changed: **{total_changed_box_attrs}**"
-    )
+        st.success(
+            f"Done! Modified XML:\n"
+            f"- Tracks affected: **{total_changed_tracks}**\n"
+            f"- Track-level attributes changed: **{total_changed_track_attrs}**\n"
+            f"- Box-level attributes changed: **{total_changed_box_attrs}**"
+        )
 
-    st.download_button(
-        "📥 Download modified XML",
-        data=out_bytes,
-        file_name=f"modified_{uploaded_file.name}",
-        mime="application/xml",
-    )
+        st.download_button(
+            "📥 Download modified XML",
+            data=out,
+            file_name=f"modified_{uploaded_file.name}",
+            mime="application/xml",
+        )
+
+
+rules_and_apply()
@@ -0,0 +1,164 @@
+# Byte-level editing of CVAT video XML: an index of where each editable
+# <attribute> body sits in the upload, and a splice that rewrites only those bytes.
+# Kept free of Streamlit so it can be imported and tested on its own.
+from array import array
+import re
+from sys import intern
+from xml.parsers import expat
+
+import numpy as np
+
+# A whole start tag, including quoted attribute values that may contain ">".
+_START_TAG = re.compile(rb"""<(?:[^>"']|"[^"]*"|'[^']*')*>""")
+
+
+class UnsupportedMarkupError(Exception):
+    # Well-formed XML whose editable <attribute>s can't be located in the raw bytes.
+    pass
+
+
+def _ascii_compatible(encoding: str) -> bool:
+    # The splice matches markup as bytes and encodes values on their own, which is
+    # only sound when ASCII markup encodes to the same bytes (UTF-8, Latin-1, ...).
+    try:
+        return "<attribute>".encode(encoding) == b"<attribute>"
+    except LookupError:
+        return False
+
+
+def build_attr_index(data: bytes):
+    # Byte spans of every <attribute> body directly under a <track> or its <box>es,
+    # so Apply can splice new values into the original bytes instead of
+    # building and re-serialising a DOM. Returns (index, spans, encoding):
+    #   spans: (starts, ends, self_closing) columns indexed by span id, in document
+    #          order: two array('q') of byte offsets and a bytearray of 0/1 flags
+    #   index: {track_id: {attr_name: (track_spans, box_frames, box_spans)}}
+    # Track-level attributes ignore the scope. Box attributes are stored column-wise:
+    # box_frames (int64) is sorted by frame and parallel to box_spans (span ids).
+    # Raises ValueError for encodings the splice can't handle (UTF-16/32), and
+    # UnsupportedMarkupError for <attribute>s that only exist after entity expansion.
+    if data[:2] in (b"\xff\xfe", b"\xfe\xff") or b"\x00" in data[:4]:
+        raise ValueError("UTF-16/UTF-32")
+    parser = expat.ParserCreate()
+    # One span per <attribute> in the file: kept column-wise, since this is the
+    # largest part of the cached index.
+    span_starts = array("q")
+    span_ends = array("q")
+    span_self_closing = bytearray()
+    pending = {}
+    encoding = "utf-8"
+    stack = []          # names of the currently open elements
+    per_attr = None     # pending entry of the enclosing <track>
+    frame_idx = 0
+    open_attr = None    # (name, tag start offset, frame or None, depth)
+
+    def xml_decl(version, decl_encoding, standalone):
+        nonlocal encoding
+        encoding = decl_encoding or encoding
+        if not _ascii_compatible(encoding):
+            raise ValueError(encoding)
+
+    def start_element(tag, attrs):
+        nonlocal per_attr, frame_idx, open_attr
+        parent = stack[-1] if stack else None
+        grandparent = stack[-2] if len(stack) > 1 else None
+        stack.append(tag)
+        if tag == "track":
+            per_attr = pending.setdefault(attrs.get("id", ""), {})
+        elif per_attr is None:
+            return
+        elif tag == "box" and parent == "track":
+            try:
+                frame_idx = int(attrs["frame"])
+            except (KeyError, ValueError):
+                frame_idx = 0
+        elif tag == "attribute":
+            if parent == "track":
+                frame = None
+            elif parent == "box" and grandparent == "track":
+                frame = frame_idx
+            else:
+                return
+            name = intern(attrs.get("name") or "")
+            open_attr = (name, parser.CurrentByteIndex, frame, len(stack))
+
+    def end_element(tag):
+        nonlocal per_attr, open_attr
+        depth = len(stack)
+        stack.pop()
+        if tag == "track":
+            per_attr = None
+        # Only the end tag of the open <attribute> itself; one nested inside its
+        # content (mixed content is valid XML) must not close the span early.
+        elif tag == "attribute" and open_attr is not None and open_attr[3] == depth:
+            name, tag_start, frame, _ = open_attr
+            open_attr = None
+            start_tag = _START_TAG.match(data, tag_start)
+            # Expat reports the offset of the entity reference for elements an
+            # internal DTD entity expands to; there are no such bytes to splice.
+            if start_tag is None or not start_tag.group().startswith(b"<attribute"):
+                raise UnsupportedMarkupError(
+                    f"The <attribute> at byte {tag_start} comes from an entity "
+                    "reference; attributes defined through DTD entities cannot be edited."
+                )
+            body_start = start_tag.end()
+            if data[body_start - 2] == ord("/"):
+                # <attribute .../>: the "/>" is replaced by ">value</attribute>"
+                span_starts.append(body_start - 2)
+                span_ends.append(body_start)
+                span_self_closing.append(1)
+            else:
+                span_starts.append(body_start)
+                span_ends.append(parser.CurrentByteIndex)
+                span_self_closing.append(0)
+            span_id = len(span_starts) - 1
+            # Box frames/span ids go into typed arrays: two 64-bit ints per box
+            # attribute instead of a tuple of Python ints.
+            track_spans, frames, span_ids = per_attr.setdefault(
+                name, ([], array("q"), array("q"))
+            )
+            if frame is None:
+                track_spans.append(span_id)
+            else:
+                try:
+                    frames.append(frame)
+                except OverflowError:
+                    raise UnsupportedMarkupError(
+                        f"Box frame {frame} does not fit in a 64-bit integer."
+                    ) from None
+                span_ids.append(span_id)
+
+    parser.XmlDeclHandler = xml_decl
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.Parse(data, True)
+
+    index = {}
+    for t_id, per_attr in pending.items():
+        index[t_id] = {}
+        for name, (track_spans, frames, span_ids) in per_attr.items():
+            # Zero-copy views over the typed arrays; fancy indexing makes the copies.
+            frames = np.frombuffer(frames, dtype=np.int64)
+            span_ids = np.frombuffer(span_ids, dtype=np.int64)
+            order = np.argsort(frames, kind="stable")
+            index[t_id][name] = (track_spans, frames[order], span_ids[order])
+    return index, (span_starts, span_ends, span_self_closing), encoding
+
+
+def splice_values(data: bytes, spans, edits, encoding: str, out):
+    # Writes `data` to the file-like `out` with the given attribute bodies replaced.
+    # `edits` yields (span id, new value bytes) in increasing span id order, i.e.
+    # document order; untouched bytes are copied as they are.
+    src = memoryview(data)
+    starts, ends, self_closing = spans
+    close_tag = "</attribute>".encode(encoding)
+    cursor = 0
+    for span_id, new_val in edits:
+        start = starts[span_id]
+        out.write(src[cursor:start])
+        if self_closing[span_id]:
+            out.write(b">" + new_val + close_tag)
+        else:
+            out.write(new_val)
+        cursor = ends[span_id]
+    out.write(src[cursor:])
@@ -0,0 +1,65 @@
+import io
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from attr_index import UnsupportedMarkupError, build_attr_index, splice_values
+
+
+def _set_all(data, value):
+    # Splices `value` into every indexed <attribute>; returns the parsed result.
+    index, spans, encoding = build_attr_index(data)
+    span_ids = sorted(
+        span_id
+        for per_attr in index.values()
+        for track_spans, _, box_spans in per_attr.values()
+        for span_id in [*track_spans, *box_spans.tolist()]
+    )
+    out = io.BytesIO()
+    splice_values(data, spans, ((i, value.encode(encoding)) for i in span_ids), encoding, out)
+    return ET.fromstring(out.getvalue())
+
+
+def test_splice_round_trips():
+    data = (
+        b'<?xml version="1.0" encoding="utf-8"?>\n<annotations>'
+        b'<meta><attribute name="occ">spec</attribute></meta>'
+        b'<track id="0"><attribute name="kind">car</attribute>'
+        b'<box frame="3"><attribute name="occ">no</attribute></box>'
+        b'<box frame="1"><attribute name="occ"/></box></track></annotations>'
+    )
+    root = _set_all(data, "Z")
+    assert root.find("meta/attribute").text == "spec"
+    assert [a.text for a in root.iter("attribute")][1:] == ["Z", "Z", "Z"]
+
+
+def test_nested_attribute_keeps_output_well_formed():
+    data = (
+        b'<annotations><track id="0"><box frame="0">'
+        b'<attribute name="occ">a<attribute name="x">b</attribute>c</attribute>'
+        b'</box></track></annotations>'
+    )
+    root = _set_all(data, "Z")
+    attr = root.find("track/box/attribute")
+    assert attr.get("name") == "occ"
+    assert attr.text == "Z"
+
+
+def test_entity_expanded_attribute_is_refused():
+    data = (
+        b"<!DOCTYPE annotations [<!ENTITY m '<attribute name=\"occ\">x</attribute>'>]>"
+        b'<annotations><track id="0"><box frame="0">&m;</box></track></annotations>'
+    )
+    with pytest.raises(UnsupportedMarkupError):
+        build_attr_index(data)
+
+
+def test_frames_beyond_int32():
+    data = (
+        b'<annotations><track id="0">'
+        b'<box frame="5000000000"><attribute name="occ">a</attribute></box>'
+        b'<box frame="7"><attribute name="occ">b</attribute></box></track></annotations>'
+    )
+    index, _, _ = build_attr_index(data)
+    _, frames, _ = index["0"]["occ"]
+    assert frames.tolist() == [7, 5000000000]